@@ -11,22 +11,45 @@ There can be more than one '^!' between lines.
 """
 
 import os
-import json
-import csv
+import mmap
 import shutil
 import re
-import random
-import string
+import itertools
 import tkinter.filedialog
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # Faster json parser, used if installed
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 INITIAL_DIR = os.path.dirname(os.path.abspath(__file__))
 TRASH_FOLDER_NAME = "Recycle-bin"
 NOTE_FILE_EXTENSION = ".txt"
+# Max number of notes written simultaneously
+MAX_WRITE_WORKERS = 32
 
 # Dump file special things
-JSON_OBJECTS_DIVIDER = r"{[!*|@]}"
+JSON_OBJECTS_DIVIDER = rb"{[!*|@]}"
 TRASH_FOLDER_CSV_NAME = " "
-
+# Start of a json object, leading whitespaces allowed
+RE_JSON_OBJECT_START = re.compile(rb'\s*{')
+# End of the last json object in the dump, whitespaces allowed around
+RE_JSON_OBJECT_END = re.compile(rb'\s*}\s*\Z')
+# Parts of the content object around its '"key":"value"' pairs
+# (strings themselves are scanned with `find_string_end`, regexes backtrack on long escaped strings)
+RE_CONTENT_KEY_START = re.compile(rb'\s*"')
+RE_CONTENT_VALUE_START = re.compile(rb'\s*:\s*"')
+RE_CONTENT_ITEMS_DIVIDER = re.compile(rb'\s*,')
+# Quote that can end a json string: not preceded by a backslash, or preceded by an escaped one
+# (starts with the quote itself, so the search skips to quotes at C speed)
+RE_STRING_END_CANDIDATE = re.compile(rb'"(?:(?<=[^\\]")|(?<=\\\\"))')
+# Characters of a json string that need the json decoder: escapes and (invalid) raw control characters
+RE_JSON_STRING_SPECIAL_CHARS = re.compile(rb'[\\\x00-\x1f]')
+
+CSV_ROW_DIVIDER = "^!"
+CSV_COL_DIVIDER = ";"
 CSV_ROW_LENGTH = 10
 
 CSV_COL_FILE_INDEX = 0
@@ -36,11 +59,11 @@ CSV_COL_FILE_NAME = 9
 # File name sanitizing things
 FILE_NAME_MAX_LEN = 50
 RE_RESTRICTED_CHARS = re.compile(r"[^\w. _-]")
-RESTRICTED_NAMES = [
+RESTRICTED_NAMES = frozenset({
     'CON', 'PRN', 'AUX', 'NUL','COM0', 'COM1', 'COM2', 'COM3', 'COM4', 'COM5',
     'COM6', 'COM7', 'COM8', 'COM9', 'COM¹', 'COM²', 'COM³', 'LPT0', 'LPT1', 'LPT2',
     'LPT3', 'LPT4', 'LPT5', 'LPT6', 'LPT7', 'LPT8', 'LPT9', 'LPT¹', 'LPT²', 'LPT³',
-]
+})
 
 # Folder path created by the script, empty string means no files created yet.
 created_path = ""
@@ -48,24 +71,28 @@ created_path = ""
 class FastNotepadParserError(Exception):
     pass
 
-def full_path(name, folder, is_dir=False):
-    """ Joins path segments, adds file extension."""
-    if is_dir:
-        return os.path.join(folder, name)
-    return f"{os.path.join(folder, name)}{NOTE_FILE_EXTENSION}"
+class RestrictedCharsTable(dict):
+    """ `str.translate` table that removes characters matched by RE_RESTRICTED_CHARS.
+    Characters are checked once, on their first lookup.
+    """
+    def __missing__(self, char_code):
+        if RE_RESTRICTED_CHARS.match(chr(char_code)):
+            self[char_code] = None
+        else:
+            self[char_code] = char_code
+        return self[char_code]
 
-def sanitize_name(name, folder, is_dir=False):
-    """ Returns a valid name for the file/folder."""
+RESTRICTED_CHARS_TABLE = RestrictedCharsTable()
 
-    def gen_unique_name(name, folder, is_dir):
-        """ Makes a file/folder name unique within its folder."""
-        characters = string.digits
-        while os.path.exists(full_path(name, folder, is_dir)):
-            name += random.choice(characters)
-        return name
+def iter_valid_paths(name, folder, used_paths, is_dir=False):
+    """ Yields valid unique paths for the file/folder `name` inside the `folder`, adds file extension.
+    `used_paths` is a set of paths already taken by the script, each yielded path is added to it.
+    The next path should be taken if the yielded one exists on disk anyway
+    (file systems can treat different names as the same one).
+    """
 
     # Remove restricted characters
-    name = RE_RESTRICTED_CHARS.sub(repl='', string=name)
+    name = name.translate(RESTRICTED_CHARS_TABLE)
 
     # Cut file name length
     name = name[:FILE_NAME_MAX_LEN]
@@ -73,22 +100,51 @@ def sanitize_name(name, folder, is_dir=False):
     # Remove whitespaces on start/end
     name = name.strip()
 
-    # Check if the name reserved
-    if name.upper() in RESTRICTED_NAMES:
-        name = ''
-
-    # Check if the name is empty
-    if name == '':
+    # Check if the name reserved, empty or points to the current/parent folder
+    if name in ('', '.', '..') or name.upper() in RESTRICTED_NAMES:
         name = '_'
 
-    # Check if the name is not unique
-    if os.path.exists(full_path(name, folder, is_dir)):
-        name = gen_unique_name(name, folder, is_dir)
+    path_prefix = os.path.join(folder, '')
+    path_suffix = '' if is_dir else NOTE_FILE_EXTENSION
+    path = f"{path_prefix}{name}{path_suffix}"
+
+    # Make the name unique within its folder by adding a number suffix
+    # (paths are compared case-insensitively on case-insensitive systems)
+    number = 1
+    while True:
+        normcased_path = os.path.normcase(path)
+        if normcased_path not in used_paths:
+            # Reserve the path
+            used_paths.add(normcased_path)
+            yield path
+        path = f"{path_prefix}{name}_{number}{path_suffix}"
+        number += 1
+
+def create_first_free(paths, create):
+    """ Calls `create(path)` for the paths one by one until one doesn't exist on disk yet.
+    Returns the created path.
+    """
+    for path in paths:
+        try:
+            create(path)
+            return path
+        except FileExistsError:
+            continue
 
-    return name
+def map_file(file_path):
+    """ Maps the notes dump file to memory. Returns read-only mmap, it should be closed by the caller."""
+    with open(file_path, 'rb') as file:
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            raise FastNotepadParserError("Error: Couldn't find expected data. Possibly wrong file.")
 
-def get_json_objects(file_path):
-    """ Returns json objects from the notes dump as dicts."""
+def get_json_objects(dump):
+    """ Returns json objects from the mapped notes dump.
+    'index' and 'folders' objects are parsed to dicts.
+    The content object is not parsed, its start offset in the dump is returned instead.
+    """
 
     def try_to_find(string, substring, rfind=False):
         if(rfind):
@@ -99,46 +155,172 @@ def get_json_objects(file_path):
             raise FastNotepadParserError("Error: Couldn't find expected data. Possibly wrong file.")
         return found
 
-    def check_json_objects(index_json, folders_json, content_json):
+    def check_layout(dump, index_start, index_end, folders_end, content_start):
+        """ Cheap checks of the dump layout, so wrong files fail before any parsing."""
+        content_end = dump.rfind(b'}') + 1
+        all_checks_ok = True
+        all_checks_ok = all_checks_ok and (dump.find(b'"index"', index_start, index_end) != -1)
+        all_checks_ok = all_checks_ok and (index_end != folders_end)
+        all_checks_ok = all_checks_ok and (RE_JSON_OBJECT_START.match(dump, content_start) is not None)
+        all_checks_ok = all_checks_ok and (content_end > content_start) and (dump[content_end:].strip() == b'')
+        if not all_checks_ok:
+            raise FastNotepadParserError("Error: Couldn't find expected data. Possibly wrong file.")
+
+    def check_json_objects(index_json, folders_json):
         all_checks_ok = True
         all_checks_ok = all_checks_ok and ("index" in index_json)
         all_checks_ok = all_checks_ok and ("folders" in folders_json)
         if not all_checks_ok:
             raise FastNotepadParserError("Error: Couldn't find expected data. Possibly wrong file.")
 
-    with open(file_path, 'r', encoding='utf-8') as file:
-        raw_string = file.read()
-
     # Get the 'index' object
-    index_start = try_to_find(raw_string, '{')
-    index_end = try_to_find(raw_string, JSON_OBJECTS_DIVIDER)
+    index_start = try_to_find(dump, b'{')
+    index_end = try_to_find(dump, JSON_OBJECTS_DIVIDER)
 
     # Get the 'folders' object
     folders_start = index_end + len(JSON_OBJECTS_DIVIDER)
-    folders_end = try_to_find(raw_string, JSON_OBJECTS_DIVIDER, rfind=True)
+    folders_end = try_to_find(dump, JSON_OBJECTS_DIVIDER, rfind=True)
 
     # Get the content object
+    # (it is the biggest one, its notes are decoded one by one right from the dump later)
     content_start = folders_end + len(JSON_OBJECTS_DIVIDER)
 
+    check_layout(dump, index_start, index_end, folders_end, content_start)
+
     # Load jsons
     try:
-        index_json = json.loads(raw_string[index_start:index_end])
-        folders_json = json.loads(raw_string[folders_start:folders_end])
-        content_json = json.loads(raw_string[content_start:])
-    except json.decoder.JSONDecodeError as e:
+        index_json = json_loads(dump[index_start:index_end])
+        folders_json = json_loads(dump[folders_start:folders_end])
+    except ValueError as e: # json.JSONDecodeError and orjson.JSONDecodeError
+        raise FastNotepadParserError(f"Error: Couldn't find expected data. Possibly wrong file. JSON load error: {e}")
+
+    check_json_objects(index_json, folders_json)
+    return index_json, folders_json, content_start
+
+def load_content(dump, content_start):
+    """ Parses the whole content object.
+    Returns dict {"_file_index": "text",}
+    """
+    try:
+        content_json = json_loads(dump[content_start:])
+    except ValueError as e: # json.JSONDecodeError and orjson.JSONDecodeError
+        raise FastNotepadParserError(f"Error: Couldn't find expected data. Possibly wrong file. JSON load error: {e}")
+
+    if not isinstance(content_json, dict):
+        raise FastNotepadParserError("Error: Couldn't find expected data. Possibly wrong file.")
+
+    return {key: value for key, value in content_json.items() if isinstance(value, str)}
+
+def decode_json_string(raw_string):
+    """ Decodes json-escaped string bytes (without quotes) to str."""
+    try:
+        return json_loads(b'"' + raw_string + b'"')
+    except ValueError as e: # json.JSONDecodeError and orjson.JSONDecodeError
         raise FastNotepadParserError(f"Error: Couldn't find expected data. Possibly wrong file. JSON load error: {e}")
 
-    check_json_objects(index_json, folders_json, content_json)
-    return index_json, folders_json, content_json
+def find_string_end(dump, string_start):
+    """ Returns the offset of the closing quote of the json string that starts at `string_start`
+    (right after its opening quote), -1 if there is no closing quote.
+    """
+    match = RE_STRING_END_CANDIDATE.search(dump, string_start)
+    while match is not None:
+        # The quote is escaped if it follows an odd number of backslashes
+        quote = match.start()
+        backslashes_start = quote
+        while backslashes_start > string_start and dump[backslashes_start - 1] == ord('\\'):
+            backslashes_start -= 1
+        if (quote - backslashes_start) % 2 == 0:
+            return quote
+        match = RE_STRING_END_CANDIDATE.search(dump, quote + 1)
+    return -1
+
+def index_content(dump, content_start):
+    """ Finds notes' texts in the raw content object without parsing the whole object.
+    Returns dict {"_file_index": (text_start, text_end),} with offsets in the dump.
+    If the content object is not a flat object of strings, it is parsed with `load_content` instead
+    and the dict values are decoded texts.
+    """
+    content_index = dict()
+
+    # Walk the top-level object: '{' "key":"value" (',' "key":"value")* '}'
+    pos = RE_JSON_OBJECT_START.match(dump, content_start).end()
+    if RE_JSON_OBJECT_END.match(dump, pos):
+        return content_index
+
+    while True:
+        # Find the key
+        match = RE_CONTENT_KEY_START.match(dump, pos)
+        key_end = -1 if match is None else find_string_end(dump, match.end())
+        if key_end == -1:
+            # Broken structure
+            return load_content(dump, content_start)
+        key = dump[match.end():key_end]
+
+        # Find the value
+        match = RE_CONTENT_VALUE_START.match(dump, key_end + 1)
+        text_end = -1 if match is None else find_string_end(dump, match.end())
+        if text_end == -1:
+            # Not a string value or broken structure
+            return load_content(dump, content_start)
+        text_start = match.end()
+
+        if b'\\' in key:
+            key = decode_json_string(key)
+        else:
+            key = key.decode('utf-8')
+        content_index[key] = (text_start, text_end)
+
+        # Go to the next pair
+        pos = text_end + 1
+        match = RE_CONTENT_ITEMS_DIVIDER.match(dump, pos)
+        if match is not None:
+            pos = match.end()
+        elif RE_JSON_OBJECT_END.match(dump, pos):
+            return content_index
+        else:
+            return load_content(dump, content_start)
+
+def get_note_data(dump, text_span):
+    """ Returns the note's text located at `text_span` of the dump as utf-8 bytes.
+    `text_span` can be the text itself if the content object was fully parsed.
+    """
+    if isinstance(text_span, str):
+        return text_span.encode('utf-8')
+
+    text_start, text_end = text_span
+    raw_text = dump[text_start:text_end]
+
+    # Text without escapes and control characters is the note's utf-8 text already,
+    # it is validated the same way as the json decoder does
+    if RE_JSON_STRING_SPECIAL_CHARS.search(raw_text) is None:
+        try:
+            raw_text.decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise FastNotepadParserError(f"Error: Couldn't find expected data. Possibly wrong file. JSON load error: {e}")
+        return raw_text
+
+    # The json decoder raises FastNotepadParserError on invalid escapes and raw control characters
+    return decode_json_string(raw_text).encode('utf-8')
+
+def write_file(file_path, data):
+    """ Writes bytes to a new file with a bare file descriptor, without python file objects.
+    Raises FileExistsError if the file exists, existing files are never overwritten.
+    The descriptor is opened in the default (text) mode, so on Windows newlines become '\\r\\n'
+    the same way as with open(file_path, 'w').
+    """
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        data = memoryview(data)
+        while len(data) > 0:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
 
-def create_folder(name, folder_path):
+def create_folder(name, folder_path, used_paths):
     """ Creates a new folder inside the `folder_path`. Returns the created path."""
-    valid_folder_name = sanitize_name(name, folder_path, is_dir=True)
-    valid_folder_path = full_path(valid_folder_name, folder_path, is_dir=True)
-    os.mkdir(valid_folder_path)
-    return valid_folder_path
+    return create_first_free(iter_valid_paths(name, folder_path, used_paths, is_dir=True), os.mkdir)
 
-def create_folders(folders_json, folder_path):
+def create_folders(folders_json, folder_path, used_paths):
     """ Creates folders that are in the dump file.
     Returns dict {"folder_name_from_dump": "created_folder_path",}
     """
@@ -158,79 +340,102 @@ def create_folders(folders_json, folder_path):
 
     # Create folders
     for folder_name in folder_list:
-        valid_folder_name = sanitize_name(folder_name, folder_path, is_dir=True)
-        valid_folder_path = full_path(valid_folder_name, folder_path, is_dir=True)
-        os.mkdir(valid_folder_path)
-        folder_paths[folder_name] = valid_folder_path
+        folder_paths[folder_name] = create_folder(folder_name, folder_path, used_paths)
 
     # Create trash folder
-    trash_folder_valid_name = create_folder(TRASH_FOLDER_NAME, folder_path)
+    trash_folder_valid_name = create_folder(TRASH_FOLDER_NAME, folder_path, used_paths)
     folder_paths[TRASH_FOLDER_CSV_NAME] = trash_folder_valid_name
 
     return folder_paths
 
 def parse_csv(csv_string):
     """ Parses the csv string.
-    Returns list: [{'index': 'bla', 'folder': 'bla', 'name': 'bla'},]"""
-    result = list()
-    csv_reader = csv.reader(csv_string.split('^!'), delimiter=';')
-    for csv_row in csv_reader:
+    Returns lists of the same length: (['file_index',], ['folder_name',], ['file_name',])"""
+
+    def iter_rows(csv_string):
+        """ Yields csv rows one by one without splitting the whole string at once."""
+        row_start = 0
+        while row_start < len(csv_string):
+            row_end = csv_string.find(CSV_ROW_DIVIDER, row_start)
+            if row_end == -1:
+                row_end = len(csv_string)
+            yield csv_string[row_start:row_end]
+            row_start = row_end + len(CSV_ROW_DIVIDER)
+
+    file_indexes = list()
+    file_folders = list()
+    file_names = list()
+    for row_string in iter_rows(csv_string):
 
         # Handle duplicated csv endline symbols
-        if len(csv_row) == 0:
+        if len(row_string) == 0:
             continue
 
-        # Parse csv row
+        # Parse csv row (the app doesn't quote fields, so a plain split is enough)
+        csv_row = row_string.split(CSV_COL_DIVIDER)
 
         if len(csv_row) != CSV_ROW_LENGTH:
             raise FastNotepadParserError("Error: Wrong 'index' data.")
 
-        file_index = f"_{csv_row[CSV_COL_FILE_INDEX]}" # with '_' prefix
-        file_folder = csv_row[CSV_COL_FOLDER_NAME]
-        file_name = csv_row[CSV_COL_FILE_NAME]
-
-        result.append({
-            'index': file_index,
-            'folder': file_folder,
-            'name': file_name,
-        })
+        file_indexes.append(f"_{csv_row[CSV_COL_FILE_INDEX]}") # with '_' prefix
+        file_folders.append(csv_row[CSV_COL_FOLDER_NAME])
+        file_names.append(csv_row[CSV_COL_FILE_NAME])
 
-    return result
+    return file_indexes, file_folders, file_names
 
-def create_files(index_json, folders_json, content_json, folder_path):
+def create_files(index_json, folders_json, dump, content_start, folder_path):
     """ Writes notes from the dump."""
 
+    def write_note(note):
+        file_paths, text_span = note
+        data = get_note_data(dump, text_span)
+        # Threads may pick the same next path, O_EXCL in write_file lets only one of them create it
+        create_first_free(file_paths, lambda file_path: write_file(file_path, data))
+
+    # Paths created in the parent folder, it is created empty by `create_folders`
+    used_paths = set()
+
     # Create_folders
-    folder_paths = create_folders(folders_json, folder_path)
+    folder_paths = create_folders(folders_json, folder_path, used_paths)
     # Parse files index
-    files_index = parse_csv(index_json['index'])
+    file_indexes, file_folders, file_names = parse_csv(index_json['index'])
+    # Find notes' texts
+    content_index = index_content(dump, content_start)
 
-    # Save the notes
-    for file_data in files_index:
+    # Resolve the notes folders, notes without a folder go to the parent folder
+    dirs_to_write_files = [
+        folder_paths[file_folder] if file_folder else folder_path
+        for file_folder in file_folders
+    ]
 
-        if file_data['folder'] == "":
-            dir_to_write_file = folder_path
-        else:
-            dir_to_write_file = folder_paths[file_data['folder']]
+    # Get the notes paths
+    notes = list()
+    for file_index, file_name, dir_to_write_file in zip(file_indexes, file_names, dirs_to_write_files):
 
-        # Sanitize file name
-        file_name = sanitize_name(file_data['name'] , dir_to_write_file)
-        # Get current note path
-        file_path = full_path(file_name, dir_to_write_file)
+        # Get current note path, the following ones are tried while writing if it exists on disk
+        file_paths = iter_valid_paths(file_name, dir_to_write_file, used_paths)
+        file_path = next(file_paths)
 
-        # Write the note
-        with open(file_path, 'w', encoding='utf-8') as file:
+        text_span = content_index.get(file_index)
+        if text_span is None:
+            raise FastNotepadParserError("Error: Couldn't find note's text!")
 
-            if file_data['index'] not in content_json:
-                raise FastNotepadParserError("Error: Couldn't find note's text!")
+        notes.append((itertools.chain([file_path], file_paths), text_span))
+
+    if len(notes) == 0:
+        return
 
-            file.write(content_json[file_data['index']])
+    # Write the notes, writes release the GIL so they overlap in threads
+    with ThreadPoolExecutor(max_workers=min(MAX_WRITE_WORKERS, len(notes))) as executor:
+        # list() reraises workers' exceptions
+        list(executor.map(write_note, notes))
 
 def parse_file(file_path):
     """ Parses notes dump file and writes notes from the dump."""
-    index_json, folders_json, content_json = get_json_objects(file_path)
     folder_to_save_notes = f"{file_path}_parsed"
-    create_files(index_json, folders_json, content_json, folder_to_save_notes)
+    with map_file(file_path) as dump:
+        index_json, folders_json, content_start = get_json_objects(dump)
+        create_files(index_json, folders_json, dump, content_start, folder_to_save_notes)
 
 def cleanup():
     """ Removes the parsed results folder.